@@ -1,168 +1,336 @@
 import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from email.message import EmailMessage
 from datetime import datetime
 from dotenv import load_dotenv
-from newsapi import NewsApiClient
 import google.generativeai as genai
 import urllib.parse
 import re
-import json
+import orjson
 import requests
 import time
+import hashlib
+import math
+import sqlite3
+import asyncio
+import aiohttp
+import aiosmtplib
+from collections import Counter
+from contextlib import closing
+from itertools import chain
+import jinja2
+from markupsafe import Markup
 
 # --- Configuration ---
 load_dotenv()
-PROCESSED_ARTICLES_FILE = 'processed_articles.txt'
+NEWS_API_URL = 'https://newsapi.org/v2/everything'
+NEWS_API_MAX_CONNECTIONS = 10
+NEWS_API_TIMEOUT_SECONDS = 10
+NEWS_API_MAX_RETRIES = 3
+NEWS_API_BACKOFF_SECONDS = 0.3
+PROCESSED_ARTICLES_DB = 'processed_articles.db'
+PROCESSED_ARTICLES_DB_VERSION = 1  # Stored as PRAGMA user_version once the legacy files have been imported.
+LEGACY_PROCESSED_ARTICLES_FILE = 'processed_articles.txt'
+TITLE_DEDUP_PREFIX_CHARS = 60  # Syndicated wire stories share a headline; only the first copy goes to the AI.
+MAX_DESCRIPTION_CHARS = 300
+ARTICLES_PER_AI_CALL = 25  # Target chunk size; chunks grow past it once the per-minute cap below is reached.
+MAX_CONCURRENT_AI_CALLS = 4
+MAX_AI_CALLS_PER_MINUTE = 10  # A run makes at most this many calls, keeping it under Gemini's free-tier requests-per-minute limit.
+AI_CACHE_DIR = 'ai_cache'
+AI_CACHE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+PARALLEL_SEND_MIN_RECIPIENTS = 4  # Below this, the report goes out as one multi-recipient message.
+PARALLEL_SEND_MAX_SESSIONS = 8
 
 # --- Helper Functions ---
+# Processed articles are tracked by 8-byte BLAKE2b digests of their URLs in a SQLite table whose primary key
+# index answers membership directly, so nothing is loaded into memory up front and inserts are transactional.
+def url_digest(url):
+    return hashlib.blake2b(url.encode(), digest_size=8).digest()
+
+def migrate_legacy_processed_articles(conn):
+    urls = set()
+    if os.path.exists(LEGACY_PROCESSED_ARTICLES_FILE):
+        with open(LEGACY_PROCESSED_ARTICLES_FILE, 'r') as f: urls = set(f.read().splitlines()) - {''}
+    # The imported URLs and the "migrated" marker commit together, so a failed import is simply retried next run.
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO seen(digest) VALUES (?)', ((url_digest(url),) for url in urls))
+        conn.execute(f'PRAGMA user_version = {PROCESSED_ARTICLES_DB_VERSION}')
+
 def load_processed_articles():
-    if not os.path.exists(PROCESSED_ARTICLES_FILE): return set()
-    with open(PROCESSED_ARTICLES_FILE, 'r') as f: return set(line.strip() for line in f)
+    # Opened on a worker thread and then used from the event loop thread, one caller at a time.
+    conn = sqlite3.connect(PROCESSED_ARTICLES_DB, check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS seen(digest BLOB PRIMARY KEY) WITHOUT ROWID')
+    if conn.execute('PRAGMA user_version').fetchone()[0] < PROCESSED_ARTICLES_DB_VERSION: migrate_legacy_processed_articles(conn)
+    return conn
+
+def save_processed_articles(urls, conn):
+    with conn: conn.executemany('INSERT OR IGNORE INTO seen(digest) VALUES (?)', ((url_digest(url),) for url in urls))
+
+def filter_new_articles(articles, conn):
+    return [a for a in articles if conn.execute('SELECT 1 FROM seen WHERE digest = ?', (url_digest(a['url']),)).fetchone() is None]
+
+# One pass over the new articles: drops syndicated duplicate headlines, formats the prompt entries and collects,
+# per entry, every URL it stands for (its duplicates included) so they can be marked processed together.
+def prepare_articles(articles):
+    entry_index, entries, entry_urls = {}, [], []
+    for a in articles:
+        key = (a.get('title') or '').strip().lower()[:TITLE_DEDUP_PREFIX_CHARS]
+        if key in entry_index:
+            entry_urls[entry_index[key]].append(a['url'])
+            continue
+        # Untitled articles have nothing to match on, so each one keeps its own entry.
+        if key: entry_index[key] = len(entries)
+        entries.append(f"Title: {a['title']}\nDesc: {(a['description'] or '')[:MAX_DESCRIPTION_CHARS]}")
+        entry_urls.append([a['url']])
+    return entries, entry_urls
 
-def save_processed_articles(urls):
-    with open(PROCESSED_ARTICLES_FILE, 'a') as f:
-        for url in urls: f.write(f"{url}\n")
+# Entries are bucketed by the digest of their URL rather than sliced in arrival order, so an entry always lands in
+# the same chunk for a given chunk count and a chunk's text (and AI cache key) only changes when its own articles do.
+# Never more chunks than the per-minute budget, so every call of a run can start at once.
+def chunk_articles(entries, entry_urls):
+    n_chunks = min(math.ceil(len(entries) / ARTICLES_PER_AI_CALL), MAX_AI_CALLS_PER_MINUTE)
+    buckets = [[] for _ in range(n_chunks)]
+    for digest, entry, urls in sorted((url_digest(urls[0]), entry, urls) for entry, urls in zip(entries, entry_urls)):
+        buckets[int.from_bytes(digest, 'little') % n_chunks].append((entry, urls))
+    buckets = [b for b in buckets if b]
+    return ["\n---\n".join(e for e, _ in b) for b in buckets], [list(chain.from_iterable(u for _, u in b)) for b in buckets]
 
-def get_financial_news(api_key, keywords):
+# Transport failures and 5xx responses are retried with exponential backoff; NewsAPI's own error payloads are not.
+async def fetch_news_for_keyword(session, keyword):
+    params = {'q': f'"{keyword}"', 'language': 'en', 'sortBy': 'publishedAt', 'pageSize': 100}
+    for attempt in range(NEWS_API_MAX_RETRIES + 1):
+        try:
+            async with session.get(NEWS_API_URL, params=params) as response:
+                if response.status < 500 or attempt == NEWS_API_MAX_RETRIES:
+                    articles = await response.json(loads=orjson.loads)
+                    if articles.get('status') == 'error': print(f"NewsAPI returned an error for '{keyword}': {articles.get('message')}")
+                    return articles.get('articles') or []
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == NEWS_API_MAX_RETRIES:
+                print(f"An error occurred while fetching news for '{keyword}': {e}")
+                return []
+        except Exception as e:
+            print(f"An error occurred while fetching news for '{keyword}': {e}")
+            return []
+        await asyncio.sleep(NEWS_API_BACKOFF_SECONDS * 2 ** attempt)
+
+# One request per keyword, issued concurrently, so each keyword gets its own 100-article page instead of sharing one.
+async def get_financial_news(api_key, keywords):
     print("Fetching financial news...")
-    try:
-        newsapi = NewsApiClient(api_key=api_key)
-        query = " OR ".join(f'"{k}"' for k in keywords)
-        articles = newsapi.get_everything(q=query, language='en', sort_by='publishedAt', page_size=100)
-        if articles['status'] == 'ok' and articles['articles']:
-            print(f"Successfully fetched {len(articles['articles'])} articles.")
-            return articles['articles']
-        return []
-    except Exception as e:
-        print(f"An error occurred while fetching news: {e}")
-        return []
+    # One pooled keep-alive session for every keyword request, so the TLS handshake is paid once per host connection.
+    connector = aiohttp.TCPConnector(limit=NEWS_API_MAX_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(total=NEWS_API_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(headers={'X-Api-Key': api_key}, connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*(fetch_news_for_keyword(session, k) for k in keywords))
+    articles = list({a['url']: a for batch in results for a in batch}.values())
+    articles.sort(key=lambda a: a.get('publishedAt') or '', reverse=True)
+    if articles: print(f"Successfully fetched {len(articles)} unique articles across {len(keywords)} keywords.")
+    return articles
 
 # --- Final, reliable AI prompt asking for sentiment on each stock ---
-def analyze_market_with_gemini(api_key, articles_text):
-    print("Analyzing market news with Gemini AI (Single Structured Call)...")
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-flash-latest')
-    prompt = f"""
-    Act as an expert market analyst. Analyze the following financial news articles. Your task is to return a single, valid JSON object that summarizes your findings.
-
-    THE JSON OBJECT MUST HAVE THIS EXACT STRUCTURE:
-    {{
-      "market_overview": "A 2-3 sentence summary of the overall market sentiment.",
-      "overall_sentiment": "Bullish", "Bearish", or "Neutral",
-      "opportunities": [
-        {{
-          "company_name": "Example Corp",
-          "ticker_symbol": "EXMPL",
-          "justification": "A concise, one-sentence justification based on the news.",
-          "sentiment": "Bullish"
-        }}
-      ]
-    }}
-
-    RULES FOR THE "sentiment" KEY:
-    - For each company, determine if the news is "Bullish", "Bearish", or "Neutral" for that specific company.
-    - Prioritize publicly traded companies.
-    - If a company is private, use "Private Company" as the ticker_symbol.
-    - If you cannot find a ticker, use "Ticker Not Found".
-    - Your entire response MUST be only the raw JSON object.
-    --- NEWS ARTICLES TO ANALYZE ---
-    {articles_text}
-    """
+# The static instructions are sent as the model's system instruction, so each request only carries the articles.
+GEMINI_SYSTEM_PROMPT = """
+Act as an expert market analyst. Analyze the following financial news articles. Your task is to return a single, valid JSON object that summarizes your findings.
+
+THE JSON OBJECT MUST HAVE THIS EXACT STRUCTURE:
+{
+  "market_overview": "A 2-3 sentence summary of the overall market sentiment.",
+  "overall_sentiment": "Bullish", "Bearish", or "Neutral",
+  "opportunities": [
+    {
+      "company_name": "Example Corp",
+      "ticker_symbol": "EXMPL",
+      "justification": "A concise, one-sentence justification based on the news.",
+      "sentiment": "Bullish"
+    }
+  ]
+}
+
+RULES FOR THE "sentiment" KEY:
+- For each company, determine if the news is "Bullish", "Bearish", or "Neutral" for that specific company.
+- Prioritize publicly traded companies.
+- If a company is private, use "Private Company" as the ticker_symbol.
+- If you cannot find a ticker, use "Ticker Not Found".
+- Your entire response MUST be only the raw JSON object.
+"""
+ARTICLES_PROMPT_TEMPLATE = "--- NEWS ARTICLES TO ANALYZE ---\n{articles}"
+
+# Configured once at import and shared by every call, so the client and its transport are set up a single time.
+genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+GEMINI_MODEL = genai.GenerativeModel(
+    'gemini-flash-latest', system_instruction=GEMINI_SYSTEM_PROMPT, generation_config={"response_mime_type": "application/json"}
+)
+
+# --- AI result memoization ---
+# Each chunk's report is cached on disk under a hash of the system prompt and the chunk prompt. Chunks are built from
+# URL-digest buckets, so when a send fails and the same articles come back, every chunk without new articles hits.
+def ai_cache_path(prompt):
+    key = hashlib.sha256(f"{GEMINI_SYSTEM_PROMPT}\0{prompt}".encode()).hexdigest()
+    return os.path.join(AI_CACHE_DIR, f"{key}.json")
+
+def load_cached_report(path):
+    try:
+        if time.time() - os.path.getmtime(path) > AI_CACHE_MAX_AGE_SECONDS: return None
+        with open(path, 'rb') as f: report = orjson.loads(f.read())
+        return report if isinstance(report, dict) else None
+    except (OSError, ValueError): return None
+
+def save_cached_report(path, report):
+    os.makedirs(AI_CACHE_DIR, exist_ok=True)
+    with open(path, 'wb') as f: f.write(orjson.dumps(report))
+
+def prune_ai_cache():
+    if not os.path.isdir(AI_CACHE_DIR): return
+    cutoff = time.time() - AI_CACHE_MAX_AGE_SECONDS
+    for entry in os.scandir(AI_CACHE_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff: os.remove(entry.path)
+
+async def analyze_articles_chunk(articles_text, semaphore):
+    prompt = ARTICLES_PROMPT_TEMPLATE.format(articles=articles_text)
+    cache_path = ai_cache_path(prompt)
+    cached = load_cached_report(cache_path)
+    if cached is not None:
+        print("Reusing cached AI analysis for an already-analyzed batch of articles.")
+        return cached
     try:
-        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-        report = json.loads(response.text)
-        print("AI analysis successful. Structured JSON report received.")
+        async with semaphore:
+            response = await GEMINI_MODEL.generate_content_async(prompt)
+        report = orjson.loads(response.text)
+        if not isinstance(report, dict): raise ValueError(f"expected a JSON object, got {type(report).__name__}")
+        save_cached_report(cache_path, report)
         return report
     except Exception as e:
         print(f"CRITICAL ERROR in AI analysis: {e}")
         print("Raw AI response was:", response.text if 'response' in locals() else "No response received.")
         return None
 
+def merge_reports(reports):
+    reports = [r for r in reports if r]
+    if not reports: return None
+    overall_sentiment = Counter(r.get('overall_sentiment', 'Neutral') for r in reports).most_common(1)[0][0]
+    # Prefer an overview written for the winning sentiment, then any overview, then the placeholder text.
+    overviews = [r.get('market_overview') for r in reports if r.get('overall_sentiment', 'Neutral') == overall_sentiment]
+    overview = next(filter(None, overviews), None) or next(filter(None, (r.get('market_overview') for r in reports)), 'No overview provided.')
+    opportunities, seen = [], set()
+    for opp in chain.from_iterable(r.get('opportunities') or [] for r in reports):
+        ticker = opp.get('ticker_symbol') or ''
+        key = (opp.get('company_name') or '').lower() if ticker in ('', 'Private Company', 'Ticker Not Found') else ticker.upper()
+        if key in seen: continue
+        seen.add(key)
+        opportunities.append(opp)
+    return {'market_overview': overview, 'overall_sentiment': overall_sentiment, 'opportunities': opportunities}
+
+# Articles are analysed in chunks with concurrent Gemini calls, then merged: the majority overall sentiment wins
+# and opportunities are deduplicated by ticker (or by company name when there is no ticker). Returns the merged
+# report and, per chunk, whether its analysis succeeded.
+async def analyze_market_with_gemini(article_chunks):
+    print(f"Analyzing market news with Gemini AI ({len(article_chunks)} structured call(s), up to {MAX_CONCURRENT_AI_CALLS} in parallel)...")
+    prune_ai_cache()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_AI_CALLS)
+    results = await asyncio.gather(*(analyze_articles_chunk(text, semaphore) for text in article_chunks))
+    report = merge_reports(results)
+    if report: print(f"AI analysis successful. Structured JSON report received for {sum(r is not None for r in results)} of {len(results)} call(s).")
+    return report, [r is not None for r in results]
+
+# --- Email template, compiled and minified once at import ---
+SENTIMENT_COLORS = {'Bullish': '#28a745', 'Bearish': '#dc3545', 'Neutral': '#6c757d'}
+
+EMAIL_CSS = """
+body { font-family: 'Poppins', sans-serif; background-color: #f0f2f5; margin: 0; padding: 0; }
+.email-container { max-width: 800px; margin: 20px auto; background-color: #ffffff; border-radius: 12px; box-shadow: 0 4px 10px rgba(0,0,0,0.05); }
+.header { background-color: #4a69bd; color: #ffffff; padding: 25px; text-align: center; border-radius: 12px 12px 0 0; }
+.content { padding: 20px 30px; } .section { margin-bottom: 25px; }
+.section h2 { color: #1e272e; font-weight: 600; font-size: 20px; border-bottom: 2px solid #eef2f7; padding-bottom: 8px; }
+.overview-box { background-color: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; }
+.overview-box p { margin: 0; font-size: 15px; line-height: 1.6; color: #495057; }
+.sentiment-badge { display: inline-block; padding: 5px 15px; border-radius: 15px; color: #fff; font-weight: 600; margin-bottom: 10px; }
+.opportunity-card { display: flex; align-items: center; justify-content: space-between; background-color: #ffffff; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-bottom: 15px; }
+.opportunity-text { flex: 1; padding-right: 20px; }
+.opportunity-text h3 { margin: 0 0 5px 0; color: #2c3e50; font-size: 18px; }
+.opportunity-text h3 span { color: #7f8c8d; font-weight: 400; font-size: 16px; }
+.opportunity-text p { margin: 0; color: #576574; font-size: 14px; line-height: 1.5; }
+.opportunity-viz { flex-shrink: 0; width: 160px; }
+.sentiment-bar-container { width: 100%; }
+.sentiment-bar { border-radius: 5px; color: white; text-align: center; font-weight: 600; font-size: 14px; padding: 8px 0; }
+.footer { color: #95a5a6; padding: 20px; text-align: center; font-size: 12px; }
+"""
+
+def minify_css(css):
+    return re.sub(r'\s*([{};:,])\s*', r'\1', re.sub(r'\s+', ' ', css)).strip()
+
+# Compiled once; autoescaping keeps AI-generated text from injecting markup into the email.
+EMAIL_HTML_TEMPLATE = (
+    '<!DOCTYPE html><html><head><link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet">'
+    '<style>{{ css }}</style></head><body><div class="email-container"><div class="header"><h1>Daily AI Market Briefing</h1></div>'
+    '<div class="content"><div class="section"><h2>Market Overview</h2><div class="overview-box">'
+    '<div class="sentiment-badge" style="background-color: {{ colors.get(overall_sentiment, colors.Neutral) }};">{{ overall_sentiment }}</div>'
+    '<p>{{ overview }}</p></div></div>'
+    '<div class="section"><h2>Potential Opportunities</h2>'
+    '{% for opp in opportunities %}{% set sentiment = opp.sentiment or "Neutral" %}'
+    '<div class="opportunity-card"><div class="opportunity-text">'
+    '<h3>{{ opp.company_name }} <span>({{ opp.ticker_symbol }})</span></h3><p>{{ opp.justification }}</p></div>'
+    '<div class="opportunity-viz"><div class="sentiment-bar-container">'
+    '<div class="sentiment-bar" style="background-color: {{ colors.get(sentiment, colors.Neutral) }};">{{ sentiment }}</div>'
+    '</div></div></div>'
+    '{% else %}<p>No specific opportunities identified in this category.</p>{% endfor %}'
+    '</div></div>'
+    '<div class="footer">Automated report for {{ report_date }}. This is not financial advice.</div>'
+    '</div></body></html>'
+)
+PLAIN_TEXT_FALLBACK = "Your AI Market Briefing is an HTML email. Open it in an HTML-capable client."
+_EMAIL_TEMPLATE = jinja2.Environment(autoescape=True).from_string(
+    EMAIL_HTML_TEMPLATE, globals={'css': Markup(minify_css(EMAIL_CSS)), 'colors': SENTIMENT_COLORS}
+)
+
 # --- NEW: Final email function with HTML/CSS Sentiment Bars ---
-def send_email_report(report_data, recipient_emails, smtp_config):
+async def send_email_report(report_data, recipient_emails, smtp_config):
     print("Preparing to send final friendly email...")
 
-    def create_opportunities_html(opportunities):
-        if not opportunities: return "<p>No specific opportunities identified in this category.</p>"
-        html = ""
-        for opp in opportunities:
-            sentiment = opp.get('sentiment', 'Neutral')
-            sentiment_colors = {'Bullish': '#28a745', 'Bearish': '#dc3545', 'Neutral': '#6c757d'}
-            sentiment_color = sentiment_colors.get(sentiment, '#6c757d')
-
-            # This is the HTML/CSS for the sentiment bar
-            sentiment_bar_html = f"""
-            <div class="sentiment-bar-container">
-                <div class="sentiment-bar" style="background-color: {sentiment_color};">
-                    {sentiment}
-                </div>
-            </div>
-            """
-
-            html += f"""
-            <div class="opportunity-card">
-                <div class="opportunity-text">
-                    <h3>{opp['company_name']} <span>({opp['ticker_symbol']})</span></h3>
-                    <p>{opp['justification']}</p>
-                </div>
-                <div class="opportunity-viz">
-                    {sentiment_bar_html}
-                </div>
-            </div>
-            """
-        return html
-
-    opportunities_html = create_opportunities_html(report_data.get('opportunities', []))
-    
-    overview_sentiment = report_data.get('overall_sentiment', 'Neutral')
-    overview = report_data.get('market_overview', 'No overview provided.')
-    sentiment_colors = {'Bullish': '#28a745', 'Bearish': '#dc3545', 'Neutral': '#6c757d'}
-    overview_sentiment_color = sentiment_colors.get(overview_sentiment, '#6c757d')
-
-    html_template = f"""
-    <!DOCTYPE html><html><head><link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;600&display=swap" rel="stylesheet"><style>
-    body {{ font-family: 'Poppins', sans-serif; background-color: #f0f2f5; margin: 0; padding: 0; }}
-    .email-container {{ max-width: 800px; margin: 20px auto; background-color: #ffffff; border-radius: 12px; box-shadow: 0 4px 10px rgba(0,0,0,0.05); }}
-    .header {{ background-color: #4a69bd; color: #ffffff; padding: 25px; text-align: center; border-radius: 12px 12px 0 0; }}
-    .content {{ padding: 20px 30px; }} .section {{ margin-bottom: 25px; }}
-    .section h2 {{ color: #1e272e; font-weight: 600; font-size: 20px; border-bottom: 2px solid #eef2f7; padding-bottom: 8px; }}
-    .overview-box {{ background-color: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; }}
-    .overview-box p {{ margin: 0; font-size: 15px; line-height: 1.6; color: #495057; }}
-    .sentiment-badge {{ display: inline-block; padding: 5px 15px; border-radius: 15px; color: #fff; background-color: {overview_sentiment_color}; font-weight: 600; margin-bottom: 10px; }}
-    .opportunity-card {{ display: flex; align-items: center; justify-content: space-between; background-color: #ffffff; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-bottom: 15px; }}
-    .opportunity-text {{ flex: 1; padding-right: 20px; }}
-    .opportunity-text h3 {{ margin: 0 0 5px 0; color: #2c3e50; font-size: 18px; }}
-    .opportunity-text h3 span {{ color: #7f8c8d; font-weight: 400; font-size: 16px; }}
-    .opportunity-text p {{ margin: 0; color: #576574; font-size: 14px; line-height: 1.5; }}
-    .opportunity-viz {{ flex-shrink: 0; width: 160px; }}
-    .sentiment-bar-container {{ width: 100%; }}
-    .sentiment-bar {{ border-radius: 5px; color: white; text-align: center; font-weight: 600; font-size: 14px; padding: 8px 0; }}
-    .footer {{ color: #95a5a6; padding: 20px; text-align: center; font-size: 12px; }}
-    </style></head><body><div class="email-container"><div class="header"><h1>Daily AI Market Briefing</h1></div>
-    <div class="content"><div class="section"><h2>Market Overview</h2><div class="overview-box">
-    <div class="sentiment-badge">{overview_sentiment}</div><p>{overview}</p></div></div>
-    <div class="section"><h2>Potential Opportunities</h2>{opportunities_html}</div>
-    </div>
-    <div class="footer">Automated report for {datetime.now().strftime('%B %d, %Y')}. This is not financial advice.</div>
-    </div></body></html>
-    """
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = f"Your AI Market Briefing - {datetime.now().strftime('%Y-%m-%d')}"
-    msg['From'] = smtp_config['user']
-    msg['To'] = ", ".join(recipient_emails)
-    msg.attach(MIMEText(html_template, 'html'))
+    html_template = _EMAIL_TEMPLATE.render(
+        overall_sentiment=report_data.get('overall_sentiment', 'Neutral'),
+        overview=report_data.get('market_overview', 'No overview provided.'),
+        opportunities=report_data.get('opportunities') or [],
+        report_date=datetime.now().strftime('%B %d, %Y'),
+    )
+
+    subject = f"Your AI Market Briefing - {datetime.now().strftime('%Y-%m-%d')}"
+
+    def build_message(to_addrs):
+        msg = EmailMessage()
+        msg['Subject'] = subject
+        msg['From'] = smtp_config['user']
+        msg['To'] = ", ".join(to_addrs)
+        msg.set_content(PLAIN_TEXT_FALLBACK)
+        msg.add_alternative(html_template, subtype='html')
+        return msg
+
+    async def send(msg, to_addrs):
+        await aiosmtplib.send(msg, recipients=to_addrs, hostname=smtp_config['host'], port=smtp_config['port'],
+                              username=smtp_config['user'], password=smtp_config['password'], use_tls=True)
+
+    if len(recipient_emails) >= PARALLEL_SEND_MIN_RECIPIENTS:
+        # Large lists: one personalised message per recipient, sent over concurrent SMTP sessions. Every send is
+        # allowed to finish so one bad address cannot cancel the others mid-transfer.
+        semaphore = asyncio.Semaphore(PARALLEL_SEND_MAX_SESSIONS)
+
+        async def send_one(recipient):
+            async with semaphore: await send(build_message([recipient]), [recipient])
+
+        results = await asyncio.gather(*(send_one(r) for r in recipient_emails), return_exceptions=True)
+        failures = [(r, e) for r, e in zip(recipient_emails, results) if isinstance(e, Exception)]
+        for recipient, e in failures: print(f"Failed to send email to {recipient}: {e}")
+        delivered = len(recipient_emails) - len(failures)
+        if delivered: print(f"Friendly email report sent successfully to {delivered} of {len(recipient_emails)} recipients!")
+        return delivered > 0
 
     try:
-        with smtplib.SMTP_SSL(smtp_config['host'], smtp_config['port']) as server:
-            server.login(smtp_config['user'], smtp_config['password'])
-            server.send_message(msg)
+        await send(build_message(recipient_emails), recipient_emails)
         print("Friendly email report sent successfully!")
+        return True
     except Exception as e:
         print(f"Failed to send email: {e}")
+        return False
 
-def main():
+async def main():
     news_api_key = os.getenv('NEWS_API_KEY')
     gemini_api_key = os.getenv('GEMINI_API_KEY')
     smtp_config = {'host': os.getenv('SMTP_HOST'),'port': int(os.getenv('SMTP_PORT', 465)),'user': os.getenv('SMTP_USER'),'password': os.getenv('EMAIL_PASSWORD')}
@@ -171,27 +339,35 @@ def main():
         print("Error: Missing one or more required environment variables.")
         return
 
-    processed_urls = load_processed_articles()
-    all_articles = get_financial_news(news_api_key, ['stock market', 'corporate earnings', 'market trends', 'finance'])
-    if not all_articles: return
+    loop = asyncio.get_running_loop()
+    # Read the processed-articles log on a worker thread while the NewsAPI request is in flight.
+    processed_db, all_articles = await asyncio.gather(
+        loop.run_in_executor(None, load_processed_articles),
+        get_financial_news(news_api_key, ['stock market', 'corporate earnings', 'market trends', 'finance']),
+    )
+    with closing(processed_db):
+        if not all_articles: return
 
-    new_articles = [a for a in all_articles if a['url'] not in processed_urls]
-    if not new_articles:
-        print("No new articles to analyze.")
-        return
-        
-    print(f"Found {len(new_articles)} new articles to analyze.")
-    formatted_articles_text = "\n---\n".join([f"Title: {a['title']}\nDesc: {a['description']}" for a in new_articles])
-    
-    parsed_report = analyze_market_with_gemini(gemini_api_key, formatted_articles_text)
-    
-    if parsed_report:
-        send_email_report(parsed_report, recipient_emails, smtp_config)
-        save_processed_articles({a['url'] for a in new_articles})
-    else:
-        print("Skipping email as AI analysis failed.")
+        new_articles = filter_new_articles(all_articles, processed_db)
+        if not new_articles:
+            print("No new articles to analyze.")
+            return
+
+        article_entries, entry_urls = prepare_articles(new_articles)
+        print(f"Found {len(new_articles)} new articles to analyze ({len(article_entries)} after removing duplicate headlines).")
+        article_chunks, chunk_urls = chunk_articles(article_entries, entry_urls)
+
+        parsed_report, chunk_succeeded = await analyze_market_with_gemini(article_chunks)
+
+        if parsed_report:
+            # Articles stay unprocessed when the send fails, so the next run analyses and sends them again.
+            if await send_email_report(parsed_report, recipient_emails, smtp_config):
+                # Articles from chunks the AI failed on stay unprocessed, so the next run analyses them again.
+                save_processed_articles(chain.from_iterable(urls for urls, ok in zip(chunk_urls, chunk_succeeded) if ok), processed_db)
+        else:
+            print("Skipping email as AI analysis failed.")
 
 if __name__ == '__main__':
     print("--- Starting AI Market Scanner v8.0 (Sentiment Edition) ---")
-    main()
+    asyncio.run(main())
     print("--- Script finished. ---")
\ No newline at end of file